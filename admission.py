@@ -0,0 +1,93 @@
+import asyncio
+from collections import OrderedDict, deque
+
+### AdmissionController caps how many peer connections are served at once,
+### globally and per IP address. Connections over the global cap wait in a
+### bounded accept queue that is drained round-robin across IPs, so a single
+### busy host cannot starve everyone else. Anything beyond the queue, over the
+### per-IP cap, or waiting too long is turned away instead of piling up.
+
+class AdmissionController(object):
+    def __init__(self, max_connections, max_per_ip, queue_size, queue_timeout):
+        self._max_connections = max_connections
+        self._max_per_ip = max_per_ip
+        self._queue_size = queue_size
+        self._queue_timeout = queue_timeout
+
+        self._active = 0
+        self._active_per_ip = {}
+        self._waiting = OrderedDict() # IP -> deque of futures, in round-robin order
+        self._waiting_count = 0
+
+    @property
+    def active(self):
+        return self._active
+
+    @property
+    def waiting(self):
+        return self._waiting_count
+
+    async def acquire(self, ip):
+        # Returns True once the connection may be served, False if it should be dropped
+        if self._active_per_ip.get(ip, 0) + len(self._waiting.get(ip, ())) >= self._max_per_ip:
+            return False
+
+        if self._active < self._max_connections and not self._waiting_count:
+            self._admit(ip)
+            return True
+
+        if self._waiting_count >= self._queue_size:
+            return False
+
+        future = asyncio.get_running_loop().create_future()
+        self._waiting.setdefault(ip, deque()).append(future)
+        self._waiting_count += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self._queue_timeout)
+        except asyncio.TimeoutError:
+            self._abandon(ip, future)
+            return False
+        except asyncio.CancelledError:
+            self._abandon(ip, future)
+            raise
+        return True
+
+    def release(self, ip):
+        self._active -= 1
+        self._active_per_ip[ip] -= 1
+        if not self._active_per_ip[ip]:
+            del self._active_per_ip[ip]
+        self._admit_next()
+
+    def _admit(self, ip):
+        self._active += 1
+        self._active_per_ip[ip] = self._active_per_ip.get(ip, 0) + 1
+
+    def _admit_next(self):
+        while self._waiting and self._active < self._max_connections:
+            # Take the first waiting IP and move it to the back of the line
+            ip, waiters = self._waiting.popitem(last=False)
+            future = waiters.popleft()
+            self._waiting_count -= 1
+            if waiters:
+                self._waiting[ip] = waiters
+            if future.done():
+                continue
+            self._admit(ip)
+            future.set_result(True)
+
+    def _abandon(self, ip, future):
+        if future.done():
+            # Admitted just as we gave up, so pass the slot on
+            self.release(ip)
+        else:
+            future.cancel()
+            self._remove_waiter(ip, future)
+
+    def _remove_waiter(self, ip, future):
+        waiters = self._waiting.get(ip)
+        if waiters and future in waiters:
+            waiters.remove(future)
+            self._waiting_count -= 1
+            if not waiters:
+                del self._waiting[ip]
@@ -0,0 +1,122 @@
+import zlib
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+### Optional on-the-wire compression for piece and file payloads.
+### Peers offer codecs in their greeting and the server picks the first one it
+### also supports. A payload is split into blocks, each sent as a 1 byte flag,
+### a 4 byte length and the block bytes, compressed only when that pays off.
+### Payloads whose leading sample barely compresses are sent raw without
+### spending CPU on the rest. Stored data is never changed. Decoding is capped
+### at the size the receiver expects, so a small payload cannot expand without bound.
+
+CODEC_NONE = 'none'
+CODEC_ZLIB = 'zlib'
+CODEC_LZ4 = 'lz4'
+
+BLOCK_SIZE = 256 * 1024
+SAMPLE_SIZE = 64 * 1024
+MIN_SAVINGS_RATIO = 0.9  # Compressed sample must be below this fraction of the original
+ZLIB_LEVEL = 1           # Favour speed; the links we care about are slow, not the CPUs
+BLOCK_HEADER_SIZE = 5
+BLOCK_RAW = 0
+BLOCK_COMPRESSED = 1
+
+def available_codecs():
+    # In order of preference: lz4 is much faster when it is installed
+    codecs = []
+    if lz4 is not None:
+        codecs.append(CODEC_LZ4)
+    codecs.append(CODEC_ZLIB)
+    return codecs
+
+def choose_codec(offered):
+    # offered is the peer's list in its order of preference
+    supported = available_codecs()
+    for codec in offered:
+        if codec in supported:
+            return codec
+    return CODEC_NONE
+
+def _compress(codec, data):
+    if codec == CODEC_LZ4:
+        return lz4.frame.compress(data)
+    return zlib.compress(data, ZLIB_LEVEL)
+
+def _decompress(codec, data, max_length):
+    # Ask for one byte more than allowed so a block that fits exactly can still reach its end marker
+    if codec == CODEC_LZ4:
+        decompressor = lz4.frame.LZ4FrameDecompressor()
+        output = decompressor.decompress(data, max_length=max_length + 1)
+        too_large = len(output) > max_length or (not decompressor.eof and not decompressor.needs_input)
+    else:
+        decompressor = zlib.decompressobj()
+        output = decompressor.decompress(data, max_length + 1)
+        too_large = len(output) > max_length or bool(decompressor.unconsumed_tail)
+    if too_large:
+        raise ValueError('Decompressed payload exceeds the expected size')
+    if not decompressor.eof:
+        raise ValueError('Truncated compressed block')
+    return output
+
+def _append_block(framed, flag, block):
+    framed.append(flag)
+    framed += len(block).to_bytes(BLOCK_HEADER_SIZE - 1, 'big')
+    framed += block
+
+def encode_payload(codec, data):
+    if codec == CODEC_NONE or not data:
+        return data
+
+    sample = data[:SAMPLE_SIZE]
+    compressible = len(_compress(codec, sample)) < len(sample) * MIN_SAVINGS_RATIO
+
+    framed = bytearray()
+    with memoryview(data) as view:
+        for start in range(0, len(data), BLOCK_SIZE):
+            block = view[start:start + BLOCK_SIZE]
+            if compressible:
+                compressed = _compress(codec, block)
+                if len(compressed) < len(block):
+                    _append_block(framed, BLOCK_COMPRESSED, compressed)
+                    continue
+            _append_block(framed, BLOCK_RAW, block)
+    return bytes(framed)
+
+def max_encoded_size(codec, size):
+    # Largest payload encode_payload can produce for size bytes: every block
+    # is at most its raw length plus a header
+    if codec == CODEC_NONE or not size:
+        return size
+    return size + BLOCK_HEADER_SIZE * -(-size // BLOCK_SIZE)
+
+def decode_payload(codec, framed, max_size):
+    # Raises ValueError as soon as the output would grow beyond max_size bytes
+    if codec == CODEC_NONE or not framed:
+        return framed
+
+    data = bytearray()
+    offset = 0
+    while offset < len(framed):
+        if offset + BLOCK_HEADER_SIZE > len(framed):
+            raise ValueError('Truncated compression block header')
+        flag = framed[offset]
+        length = int.from_bytes(framed[offset + 1:offset + BLOCK_HEADER_SIZE], 'big')
+        offset += BLOCK_HEADER_SIZE
+        block = framed[offset:offset + length]
+        if len(block) != length:
+            raise ValueError('Truncated compression block')
+        offset += length
+        remaining = max_size - len(data)
+        if flag == BLOCK_COMPRESSED:
+            data += _decompress(codec, block, remaining)
+        elif flag == BLOCK_RAW:
+            if length > remaining:
+                raise ValueError('Decompressed payload exceeds the expected size')
+            data += block
+        else:
+            raise ValueError(f'Unknown compression block flag {flag}')
+    return bytes(data)
@@ -0,0 +1,90 @@
+from bcoding import bdecode, bencode
+import os
+
+### HashCache remembers which pieces have already been verified against a torrent.
+### Entries are keyed by file path and are only trusted while the file's size,
+### mtime and inode are unchanged. The same file doubles as the fast-resume state
+### written by `python main.py create`, so a fresh seeder can skip re-hashing.
+
+CACHE_VERSION = 1
+RESUME_FILE_SUFFIX = '.resume'
+
+def default_cache_path(torrent_file_path):
+    return torrent_file_path + RESUME_FILE_SUFFIX
+
+def file_key(path):
+    # Identity of a file on disk: (absolute path, size, mtime, inode)
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (os.path.abspath(path), stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+def _to_ranges(indices):
+    ranges = []
+    for index in sorted(indices):
+        if ranges and ranges[-1][1] == index - 1:
+            ranges[-1][1] = index
+        else:
+            ranges.append([index, index])
+    return ranges
+
+def _from_ranges(ranges):
+    indices = set()
+    for start, end in ranges:
+        indices.update(range(start, end + 1))
+    return indices
+
+def _entry_matches(entry, key):
+    return bool(entry) and (entry.get('size'), entry.get('mtime'), entry.get('inode')) == key[1:]
+
+class HashCache(object):
+    def __init__(self, path):
+        self._path = path
+        self._files = {}
+        self._load()
+
+    def _load(self):
+        if not self._path or not os.path.isfile(self._path):
+            return
+        try:
+            with open(self._path, 'rb') as f:
+                data = bdecode(f.read())
+        except Exception as e:
+            print(f"Ignoring unreadable hash cache {self._path}: {e}")
+            return
+        if data.get('version') != CACHE_VERSION:
+            print(f"Ignoring hash cache {self._path} with unknown version.")
+            return
+        self._files = data.get('files', {})
+
+    def save(self):
+        if not self._path:
+            return
+        tmp_path = self._path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(bencode({'version': CACHE_VERSION, 'files': self._files}))
+        os.replace(tmp_path, self._path)
+
+    def verified_pieces(self, info_hash, key):
+        # Piece indices previously verified for this torrent against this exact file
+        if key is None:
+            return set()
+        entry = self._files.get(key[0])
+        if not _entry_matches(entry, key):
+            return set()
+        return _from_ranges(entry.get('torrents', {}).get(info_hash, []))
+
+    def record(self, info_hash, key, piece_indices):
+        # key should be taken before the file was hashed, so a file modified
+        # while hashing is never mistaken for a verified one
+        if key is None:
+            return
+        path, size, mtime, inode = key
+        entry = self._files.get(path)
+        if not _entry_matches(entry, key):
+            entry = {'size': size, 'mtime': mtime, 'inode': inode, 'torrents': {}}
+            self._files[path] = entry
+        verified = _from_ranges(entry['torrents'].get(info_hash, []))
+        verified.update(piece_indices)
+        entry['torrents'][info_hash] = _to_ranges(verified)
@@ -78,6 +78,68 @@ def test_torrent():
         print(f"Error reading torrent file. {e}")
 
 
+def parse_nodes(nodes_arg):
+    """
+    Parse a comma separated list of host:port bootstrap nodes.
+    Returns None if the list is malformed.
+    """
+    try:
+        bootstrap_nodes = []
+        for node in nodes_arg.split(','):
+            host, port = node.rsplit(':', 1)
+            bootstrap_nodes.append((host, int(port)))
+        return bootstrap_nodes
+    except ValueError:
+        print(f"Invalid bootstrap nodes: {nodes_arg}. Expected host:port[,host:port...]")
+        return None
+
+
+def create_torrent():
+    """
+    Create a torrent file for the files in a directory.
+    Pieces are hashed in parallel; pass --resume to also write the fast-resume state
+    next to the torrent so the seeder starts without re-hashing.
+    """
+    from torrent_creator import TorrentCreator
+
+    args = [arg for arg in sys.argv[2:] if not arg.startswith('--')]
+    if len(args) < 3:
+        print("Usage: python main.py create <source_directory> <torrent_file_path> <host:port>[,<host:port>...] [--resume]")
+        return
+
+    source_directory, torrent_file_path, nodes_arg = args[0], args[1], args[2]
+    if not torrent_file_path.endswith('.torrent'):
+        print(f"Output file is not a .torrent file: {torrent_file_path}")
+        return
+
+    bootstrap_nodes = parse_nodes(nodes_arg)
+    if not bootstrap_nodes:
+        return
+
+    try:
+        creator = TorrentCreator(source_directory, bootstrap_nodes)
+        creator.create(torrent_file_path, write_resume='--resume' in sys.argv)
+    except Exception as e:
+        print(f"Error creating torrent file. {e}")
+
+
+def release_pieces():
+    """
+    Drop a torrent's references from the shared piece store, e.g. before deleting its files.
+    Pieces no other torrent holds are copied into the store and stay until it needs the space.
+    """
+    from piece_store import PieceStore
+
+    if len(sys.argv) < 4:
+        print("Usage: python main.py release_pieces <piece_store_directory> <info_hash>")
+        return
+
+    store = PieceStore(sys.argv[2])
+    released = store.release(sys.argv[3].lower())
+    store.save()
+    print(f"Released {released} pieces for info_hash {sys.argv[3]}.")
+
+
 def test_socket_server():
     """
     Test the socket server functionality.
@@ -110,16 +172,70 @@ def test_socket_client():
     except Exception as e:
         print(f"An error occurred: {e}")
     
-async def test_p2p_client():
+def pop_profile_option():
+    """
+    Remove '--profile [output]' from the command line and return the output path.
+    Returns None when profiling was not requested.
+    """
+    if '--profile' not in sys.argv:
+        return None
+    index = sys.argv.index('--profile')
+    output_path = 'p2p_profile'
+    if index + 1 < len(sys.argv) and not sys.argv[index + 1].startswith('--'):
+        output_path = sys.argv[index + 1]
+        del sys.argv[index + 1]
+    del sys.argv[index]
+    return output_path
+
+
+def pop_piece_store_option():
+    """
+    Remove '--piece-store <directory> [capacity_bytes]' from the command line.
+    Returns (directory, capacity); both are None when no piece store was requested.
+    """
+    if '--piece-store' not in sys.argv:
+        return None, None
+    index = sys.argv.index('--piece-store')
+    if index + 1 >= len(sys.argv) or sys.argv[index + 1].startswith('--'):
+        print("Usage: --piece-store <directory> [capacity_bytes]")
+        sys.exit(1)
+    directory = sys.argv[index + 1]
+    capacity = None
+    if index + 2 < len(sys.argv) and sys.argv[index + 2].isdigit():
+        capacity = int(sys.argv[index + 2])
+        del sys.argv[index + 2]
+    del sys.argv[index:index + 2]
+    return directory, capacity
+
+
+async def run_node(node, profiler):
+    """
+    Run a P2P node, profiling it for the whole run when a profiler is given.
+    Results are written when the node stops, including on Ctrl+C.
+    """
+    profiler.start()
+    try:
+        await node.run()
+    finally:
+        profiler.stop()
+
+
+async def test_p2p_client(profile_output=None, piece_store_directory=None, piece_store_capacity=None):
     """
     Test the P2PClient functionality.
     This function initializes a P2PClient instance and connects to a torrent.
+    Pass --profile [output] to record event loop lag, timing spans and a cProfile dump,
+    and --piece-store <directory> [capacity_bytes] to share pieces with other torrents.
     """
     from p2p_client import P2PClient
+    from profiler import NULL_PROFILER, Profiler
+
+    profiler = Profiler(profile_output) if profile_output else NULL_PROFILER
 
     if len(sys.argv) < 3:
         print("Usage: python main.py test_p2p_client <mode>")
-        print("Modes: seeder, client")
+        print("Modes: seeder, client, info_hash <info_hash> <host:port>[,<host:port>...]")
+        print("Add --profile [output] to profile the run, --piece-store <directory> [capacity_bytes] to use a shared piece store.")
         return
     
     mode = sys.argv[2].lower()
@@ -136,11 +252,14 @@ async def test_p2p_client():
                 seed_directory=seeder_seed_dir,
                 server_host='0.0.0.0',
                 server_port=5000,
+                piece_store_directory=piece_store_directory,
+                piece_store_capacity=piece_store_capacity,
+                profiler=profiler,
             )
             
             if await seeder_node.connect_and_get_torrent():
                 print("Seeder setup successful. Starting peer server and Kademlia.")
-                await seeder_node.run()
+                await run_node(seeder_node, profiler)
             else:
                 print("Seeder setup failed.")
 
@@ -156,11 +275,14 @@ async def test_p2p_client():
                 seed_directory=seeder_seed_dir,
                 server_host='0.0.0.0',
                 server_port=5000,
+                piece_store_directory=piece_store_directory,
+                piece_store_capacity=piece_store_capacity,
+                profiler=profiler,
             )
             
             if await seeder_node.connect_and_get_torrent():
                 print("Seeder setup successful. Starting peer server and Kademlia.")
-                await seeder_node.run()
+                await run_node(seeder_node, profiler)
             else:
                 print("Seeder setup failed.")
 
@@ -174,22 +296,59 @@ async def test_p2p_client():
                 torrent_file_path=client_torrent_path,
                 server_host='127.0.0.1',
                 server_port=5000,
+                piece_store_directory=piece_store_directory,
+                piece_store_capacity=piece_store_capacity,
+                profiler=profiler,
+            )
+
+            if await client_node.connect_and_get_torrent():
+                print("Client setup successful. Starting peer server and Kademlia.")
+                await run_node(client_node, profiler)
+            else:
+                print("Client setup failed.")
+
+        case 'info_hash':
+            # Join without the central server: fetch the torrent metadata from peers in the DHT
+            if len(sys.argv) < 5:
+                print("Usage: python main.py test_p2p_client info_hash <info_hash> <host:port>[,<host:port>...]")
+                return
+            bootstrap_nodes = parse_nodes(sys.argv[4])
+            if not bootstrap_nodes:
+                return
+
+            print("Starting in client mode with info_hash.")
+            client_node = P2PClient(
+                kademlia_port=6883,
+                kademlia_host='0.0.0.0',
+                is_seeder=False,
+                torrent_file_path='downloads/downloaded.torrent',
+                info_hash=sys.argv[3].lower(),
+                bootstrap_nodes=bootstrap_nodes,
+                piece_store_directory=piece_store_directory,
+                piece_store_capacity=piece_store_capacity,
+                profiler=profiler,
             )
 
             if await client_node.connect_and_get_torrent():
                 print("Client setup successful. Starting peer server and Kademlia.")
-                await client_node.run()
+                await run_node(client_node, profiler)
             else:
                 print("Client setup failed.")
 
 if __name__ == "__main__":
     if len(sys.argv) < 2:
-        print("Usage: python main.py <mode> | <test_torrent> | <test_socket_server> | <test_socket_client>")
+        print("Usage: python main.py <mode> | <create> | <release_pieces> | <test_torrent> | <test_socket_server> | <test_socket_client>")
         sys.exit(1)
 
+    profile_output = pop_profile_option()
+    piece_store_directory, piece_store_capacity = pop_piece_store_option()
     mode = sys.argv[1].lower()
 
     match mode:
+        case 'create':
+            create_torrent()
+        case 'release_pieces':
+            release_pieces()
         case 'test_torrent':
             test_torrent()
         case 'test_socket_server':
@@ -198,11 +357,11 @@ if __name__ == "__main__":
             test_socket_client()
         case 'test_p2p_client':
             try:
-                asyncio.run(test_p2p_client())
+                asyncio.run(test_p2p_client(profile_output, piece_store_directory, piece_store_capacity))
             except KeyboardInterrupt:
                 print("Test P2P Client interrupted.")
         case _:
-            print("Invalid mode. Use 'test_torrent', 'test_socket_server', or 'test_socket_client'.")
+            print("Invalid mode. Use 'create', 'release_pieces', 'test_torrent', 'test_socket_server', or 'test_socket_client'.")
             sys.exit(1)
 
 
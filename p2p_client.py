@@ -1,10 +1,21 @@
 import asyncio
+import hashlib
+import itertools
 import logging
 import os
+from concurrent.futures import ProcessPoolExecutor
 from torrent import Torrent
+from hash_cache import HashCache, default_cache_path, file_key
+from piece_hasher import batch_pieces, build_piece_segments, hash_piece_batch, read_piece
+from peer_quality import PeerQualityTable
+from admission import AdmissionController
+from piece_store import PieceStore
+from profiler import NULL_PROFILER, profiled
+from compression import CODEC_NONE, available_codecs, choose_codec, decode_payload, encode_payload, max_encoded_size
 from socket_client import SocketClient
 from socket_server import SocketServer
 from kademlia.network import Server
+from bcoding import bencode
 
 # --- Kademlia Logging ---
 handler = logging.StreamHandler()
@@ -21,9 +32,33 @@ KADEMLIA_PORT = 6881
 KADEMLIA_HOST = '0.0.0.0'
 BUFFER_SIZE = 4096
 LENGTH_HEADER_SIZE = 8
+CONNECT_TIMEOUT = 10
+PIECE_RETRY_DELAY = 5         # Seconds to wait when a peer has none of the pieces we still need
+ENDGAME_MAX_REQUESTS = 3      # Peers a single piece may be requested from at once during endgame
+MAX_DOWNLOAD_PEERS = 8        # Peers we download from at the same time
+MAX_ANNOUNCED_PEERS = 50      # Peers kept in the DHT value for an info_hash
+
+# --- Peer Server Admission Limits ---
+MAX_PEER_CONNECTIONS = 64          # Connections served at once
+MAX_PEER_CONNECTIONS_PER_IP = 4    # Connections served or queued per remote IP
+ACCEPT_QUEUE_SIZE = 128            # Connections waiting for a free slot
+ACCEPT_QUEUE_TIMEOUT = 10          # Seconds a connection may wait for a slot
+HANDSHAKE_TIMEOUT = 10             # Seconds a peer has to send its greeting
+IDLE_TIMEOUT = 60                  # Seconds a peer may stay silent between requests
+READ_BUFFER_LIMIT = 4096           # Longest request line we buffer
+SEND_SLICE_SIZE = 256 * 1024       # Bytes written per drain; the idle timeout applies to each slice
+
+# --- Metadata Exchange ---
+METADATA_CHUNK_SIZE = 16384        # Bytes of the info dict sent per GET_METADATA request
+MAX_METADATA_SIZE = 64 * 1024 * 1024
+METADATA_ATTEMPTS = 5              # DHT lookups before giving up on fetching metadata
+METADATA_RETRY_DELAY = 10
 
 class P2PClient:
-    def __init__(self, kademlia_port, kademlia_host, is_seeder=False, torrent_file_path=None, seed_directory=None, server_host=None, server_port=None):
+    def __init__(self, kademlia_port, kademlia_host, is_seeder=False, torrent_file_path=None, seed_directory=None, server_host=None, server_port=None, hash_cache_path=None, verify_workers=None,
+                 max_peer_connections=MAX_PEER_CONNECTIONS, max_peer_connections_per_ip=MAX_PEER_CONNECTIONS_PER_IP,
+                 handshake_timeout=HANDSHAKE_TIMEOUT, idle_timeout=IDLE_TIMEOUT, info_hash=None, bootstrap_nodes=None,
+                 enable_compression=True, piece_store_directory=None, piece_store_capacity=None, profiler=None):
         self._kademlia_port = kademlia_port
         self._kademlia_host = kademlia_host
 
@@ -37,14 +72,54 @@ class P2PClient:
         self._download_directory = 'downloads'
         self._file_statuses = {}  # Dictionary to track which files are complete
         self._file_data = {}      # Dictionary to hold file content
+        self._file_paths = {}     # Torrent file name -> path on disk
+        self._path_files = {}     # Path on disk -> torrent file name
+
+        # State for piece verification and serving
+        self._piece_segments = []            # Per piece list of (path, offset, length)
+        self._verified_pieces = set()        # Pieces we have checked against the torrent hashes
+        self._file_pieces_remaining = {}     # Torrent file name -> pieces still unverified
+        self._hash_cache_path = hash_cache_path
+        self._verify_workers = verify_workers
+
+        # State for piece downloads (client)
+        self._wanted_pieces = {}             # Ordered set of piece indices still to download
+        self._piece_requests = {}            # Piece index -> {peer address: request task}
+        self._peer_tasks = {}                # Peer address -> connection task
+        self._known_peers = set()            # Every peer address the DHT has given us
+        self._peer_quality = PeerQualityTable()
+
+        # Admission control for the peer server
+        self._admission = AdmissionController(
+            max_peer_connections, max_peer_connections_per_ip, ACCEPT_QUEUE_SIZE, ACCEPT_QUEUE_TIMEOUT
+        )
+        self._handshake_timeout = handshake_timeout
+        self._idle_timeout = idle_timeout
+
+        # Codecs we offer when downloading; the serving peer picks one per connection.
+        # With compression disabled we neither offer codecs nor accept them when serving
+        self._enable_compression = enable_compression
+        self._offered_codecs = available_codecs() if enable_compression else []
+
+        # Content-addressed piece store shared with other torrents on this node
+        self._piece_store = None
+        if piece_store_directory:
+            self._piece_store = PieceStore(piece_store_directory, piece_store_capacity)
         
         # Initialize the asyncio lock for thread safety
         self._download_lock = asyncio.Lock()
+
+        # Timing spans and loop lag sampling; a no-op unless profiling was requested in main.py
+        self._profiler = profiler or NULL_PROFILER
         
         # Socket server details for clients to download torrent metadata
         self._server_host = server_host
         self._server_port = server_port
 
+        # Alternatively, clients can fetch the metadata from peers knowing only the info_hash
+        self._info_hash = info_hash
+        self._bootstrap_nodes = bootstrap_nodes or []
+
     async def connect_and_get_torrent(self):
         if self._is_seeder:
             # Seeder: Load the torrent file directly from the local path
@@ -54,74 +129,335 @@ class P2PClient:
             
             self._torrent = Torrent(self._torrent_file_path)
             
-            # The seeder loads all file content from the directory and marks as complete
+            # The seeder checks that all files exist in the directory; their content is verified in run()
             if not os.path.isdir(self._seed_directory):
                 print(f"Error: Seeder directory '{self._seed_directory}' not found.")
                 return False
 
+            # Files are served from disk once their pieces are verified, see _verify_seed_directory
             for file in self._torrent.torrent_files:
                 file_path = os.path.join(self._seed_directory, file)
                 if os.path.exists(file_path):
-                    with open(file_path, 'rb') as f:
-                        self._file_data[file] = f.read()
-                    self._file_statuses[file] = True # Mark as complete
+                    self._file_statuses[file] = False # Complete once all of its pieces are verified
                 else:
                     print(f"Error: Seeder file not found at {file_path}. Cannot seed.")
                     return False
-            print(f"File Data: {self._file_data}")
+            self._build_piece_segments(self._seed_directory)
+            if not self._piece_count_matches():
+                return False
+            if not self._hash_cache_path:
+                self._hash_cache_path = default_cache_path(self._torrent_file_path)
             print(f"File Statuses: {self._file_statuses}")
             
             print(f"Seeder initialized with torrent from {self._torrent_file_path}")
             return True
         else:
-            # Regular client: Download torrent file from the socket server
-            if not self._server_host or not self._server_port:
-                print("Error: Client requires a server host and port to download torrent metadata.")
+            torrent_filename = self._torrent_file_path if self._torrent_file_path else "downloads/downloaded.torrent"
+            if not os.path.exists(self._download_directory):
+                os.makedirs(self._download_directory)
+
+            if self._info_hash:
+                # Client with an info_hash: fetch the metadata from peers in the swarm
+                if not await self._fetch_torrent_from_peers(torrent_filename):
+                    return False
+            else:
+                # Regular client: Download torrent file from the socket server
+                if not self._server_host or not self._server_port:
+                    print("Error: Client requires a server host and port, or an info_hash, to download torrent metadata.")
+                    return False
+                
+                client = SocketClient(self._server_host, self._server_port)
+                if not client.connect() or not client.request_and_get_torrent_file(torrent_filename):
+                    return False
+
+            self._torrent = Torrent(torrent_filename)
+            for file in self._torrent.torrent_files:
+                self._file_statuses[file] = False # Client starts with no files
+                self._file_data[file] = b''      # Initialize with empty data
+            self._build_piece_segments(self._download_directory)
+            if not self._piece_count_matches():
                 return False
+            if self._piece_store:
+                # Other torrents' pieces indexed in files we are about to overwrite get copied into the store
+                await asyncio.get_running_loop().run_in_executor(
+                    None, self._piece_store.detach_files, list(self._file_paths.values()), self._torrent.info_hash
+                )
+            self._preallocate_download_files()
+            if self._torrent.piece_hashes:
+                # Empty files have no pieces to download; preallocating them completed them
+                for file, remaining in self._file_pieces_remaining.items():
+                    if remaining == 0:
+                        self._file_statuses[file] = True
+            self._wanted_pieces = dict.fromkeys(range(len(self._piece_segments)))
+            await self._adopt_stored_pieces()
             
-            client = SocketClient(self._server_host, self._server_port)
-            torrent_filename = self._torrent_file_path if self._torrent_file_path else "downloads/downloaded.torrent"
-            if client.connect():
-                if client.request_and_get_torrent_file(torrent_filename):
-                    self._torrent = Torrent(torrent_filename)
-                    if not os.path.exists(self._download_directory):
-                        os.makedirs(self._download_directory)
-                    for file in self._torrent.torrent_files:
-                        self._file_statuses[file] = False # Client starts with no files
-                        self._file_data[file] = b''      # Initialize with empty data
-                    
-                    print(f"File Data: {self._file_data}")
-                    print(f"File Statuses: {self._file_statuses}")
+            print(f"File Data: {self._file_data}")
+            print(f"File Statuses: {self._file_statuses}")
 
-                    return True
+            return True
+
+    @profiled('adopt_stored_pieces')
+    async def _adopt_stored_pieces(self):
+        # Pieces we already hold for other torrents need not be downloaded again
+        if not self._piece_store or not self._torrent.piece_hashes:
+            return
+        loop = asyncio.get_running_loop()
+        adopted = 0
+        for index in list(self._wanted_pieces):
+            piece_hash = self._torrent.piece_hashes[index]
+            if not self._piece_store.has(piece_hash):
+                continue
+            piece_data = await loop.run_in_executor(None, self._piece_store.get, piece_hash)
+            if piece_data is None:
+                continue
+            await loop.run_in_executor(None, self._write_piece, index, piece_data)
+            self._piece_store.add(piece_hash, self._piece_segments[index], self._torrent.info_hash)
+            del self._wanted_pieces[index]
+            self._mark_piece_verified(index)
+            adopted += 1
+
+        if adopted:
+            await loop.run_in_executor(None, self._piece_store.save)
+        print(f"Reused {adopted} of {len(self._piece_segments)} pieces from the piece store.")
+
+    async def _fetch_torrent_from_peers(self, torrent_filename):
+        if not self._bootstrap_nodes:
+            print("Error: Fetching metadata by info_hash requires at least one bootstrap node.")
+            return False
+        await self._start_kademlia(self._bootstrap_nodes)
+
+        info_hash_bytes = self._info_hash.encode('utf-8')
+        for attempt in range(METADATA_ATTEMPTS):
+            with self._profiler.span('dht_get'):
+                found_peers = self._parse_peer_list(await self._kademlia_server.get(info_hash_bytes))
+            for peer in self._peer_quality.ranked(found_peers):
+                metadata = await self._fetch_metadata(*peer)
+                if metadata is None:
+                    continue
+                if hashlib.sha1(metadata).hexdigest() != self._info_hash:
+                    print(f"Metadata from peer {peer} does not match info_hash {self._info_hash}.")
+                    self._peer_quality.record_error(peer)
+                    continue
+
+                # Splice the verified info dict in verbatim so the info_hash is preserved
+                nodes = [[host, port] for host, port in self._bootstrap_nodes]
+                with open(torrent_filename, 'wb') as f:
+                    f.write(b'd4:info' + metadata + b'5:nodes' + bencode(nodes) + b'e')
+                print(f"Fetched torrent metadata ({len(metadata)} bytes) from peer {peer}.")
+                return True
+
+            print(f"No peer could provide metadata for {self._info_hash} yet. Will try again.")
+            await asyncio.sleep(METADATA_RETRY_DELAY)
+        return False
+
+    @profiled('fetch_metadata')
+    async def _fetch_metadata(self, peer_ip, peer_port):
+        # Download the bencoded info dict from a peer in METADATA_CHUNK_SIZE chunks
+        peer = (peer_ip, peer_port)
+        timer = self._peer_quality.get(peer).timeout
+        writer = None
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(peer_ip, peer_port), CONNECT_TIMEOUT)
+            writer.write(f"HELLO:{self._info_hash}\n".encode('utf-8'))
+
+            metadata = bytearray()
+            total_size = None
+            chunk = 0
+            while total_size is None or len(metadata) < total_size:
+                writer.write(f"GET_METADATA:{chunk}\n".encode('utf-8'))
+                await writer.drain()
+
+                size_bytes = await asyncio.wait_for(reader.readexactly(LENGTH_HEADER_SIZE), timer.header_timeout())
+                announced_size = int.from_bytes(size_bytes, 'big')
+                # Sizes are checked before reading the chunk so a peer cannot make us buffer more than the metadata
+                if not announced_size or announced_size > MAX_METADATA_SIZE or total_size not in (None, announced_size):
+                    print(f"Peer {peer} cannot provide metadata for {self._info_hash}.")
+                    return None
+                total_size = announced_size
+                chunk_data = await self._receive_file_data(
+                    reader, timer, min(METADATA_CHUNK_SIZE, total_size - len(metadata))
+                )
+                if not chunk_data:
+                    print(f"Peer {peer} cannot provide metadata for {self._info_hash}.")
+                    return None
+                metadata += chunk_data
+                chunk += 1
+            return bytes(metadata)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, OSError) as e:
+            print(f"Failed to fetch metadata from peer {peer}: {e!r}")
+            self._peer_quality.record_disconnect(peer)
+            return None
+        finally:
+            if writer:
+                writer.close()
+                try:
+                    await writer.wait_closed()
+                except ConnectionError:
+                    pass
+
+    def _build_piece_segments(self, directory):
+        # Map every piece onto the (path, offset, length) ranges of the files it covers
+        self._file_paths = {file: os.path.join(directory, file) for file in self._torrent.torrent_files}
+        file_entries = [
+            (self._file_paths[file], length)
+            for file, length in zip(self._torrent.torrent_files, self._torrent.file_lengths)
+        ]
+        if self._torrent.piece_length:
+            self._piece_segments = build_piece_segments(file_entries, self._torrent.piece_length)
+
+        self._path_files = {path: file for file, path in self._file_paths.items()}
+        self._file_pieces_remaining = {file: 0 for file in self._torrent.torrent_files}
+        for segments in self._piece_segments:
+            for path, _, _ in segments:
+                self._file_pieces_remaining[self._path_files[path]] += 1
+
+    def _piece_count_matches(self):
+        # Torrents without piece hashes are transferred file by file and have nothing to check
+        piece_hashes = self._torrent.piece_hashes
+        if piece_hashes and len(piece_hashes) != len(self._piece_segments):
+            print(f"Error: Torrent lists {len(piece_hashes)} pieces but its files make up {len(self._piece_segments)}.")
             return False
+        return True
+
+    def _preallocate_download_files(self):
+        # Pieces are written in place at their offsets, so every file needs its final size up front
+        for file, length in zip(self._torrent.torrent_files, self._torrent.file_lengths):
+            file_path = self._file_paths[file]
+            if not os.path.exists(file_path) or os.path.getsize(file_path) != length:
+                with open(file_path, 'wb') as f:
+                    f.truncate(length)
 
     async def run(self):
+        # Seeders start verifying their data right away; verified pieces are served
+        # as soon as they are known to be good
+        verification_task = None
+        if self._is_seeder:
+            verification_task = asyncio.create_task(self._prepare_seed_data())
+
+        # Clients that fetched metadata by info_hash have already joined the DHT
+        if not self._kademlia_server:
+            await self._start_kademlia(self._torrent.bootstrap_nodes)
+
+        # Run the P2P server and the peer discovery loop concurrently
+        peer_server_task = asyncio.create_task(self.start_peer_server())
+        peer_discovery_task = asyncio.create_task(self.start_kademlia_peer_discovery())
+        
+        tasks = [peer_server_task, peer_discovery_task]
+        if verification_task:
+            tasks.append(verification_task)
+        await asyncio.gather(*tasks)
+
+    async def _start_kademlia(self, bootstrap_nodes):
         # Initialize Kademlia server
         self._kademlia_server = Server()
         await self._kademlia_server.listen(self._kademlia_port, self._kademlia_host)
         print(f"Kademlia DHT client listening on {self._kademlia_host}:{self._kademlia_port}")
         
         # Bootstrap into the Kademlia DHT
-        if self._torrent.bootstrap_nodes:
-            decoded_nodes = [(host, port) for host, port in self._torrent.bootstrap_nodes]
-            await self._kademlia_server.bootstrap(decoded_nodes)
+        if bootstrap_nodes:
+            decoded_nodes = [(host, port) for host, port in bootstrap_nodes]
+            with self._profiler.span('dht_bootstrap'):
+                await self._kademlia_server.bootstrap(decoded_nodes)
             print("Kademlia bootstrap successful.")
         else:
             print("No DHT bootstrap nodes provided.")
 
-        # Run the P2P server and the peer discovery loop concurrently
-        peer_server_task = asyncio.create_task(self.start_peer_server())
-        peer_discovery_task = asyncio.create_task(self.start_kademlia_peer_discovery())
-        
-        await asyncio.gather(peer_server_task, peer_discovery_task)
+    async def _prepare_seed_data(self):
+        await self._verify_seed_directory()
+        if self._piece_store and self._torrent.piece_hashes:
+            await self._index_verified_pieces()
+
+    async def _index_verified_pieces(self):
+        # Share our verified pieces with other torrents; the store reads them from our files, nothing is copied
+        info_hash = self._torrent.info_hash
+        for index in sorted(self._verified_pieces):
+            self._piece_store.add(self._torrent.piece_hashes[index], self._piece_segments[index], info_hash)
+        await asyncio.get_running_loop().run_in_executor(None, self._piece_store.save)
+        print(f"Indexed {len(self._verified_pieces)} pieces in the piece store.")
+
+    @profiled('verify_seed_directory')
+    async def _verify_seed_directory(self):
+        piece_hashes = self._torrent.piece_hashes
+        if not piece_hashes:
+            print("Torrent has no piece hashes. Seeding files without verification.")
+            for file in self._file_statuses:
+                self._file_statuses[file] = True
+            return
+        # Empty files have no pieces to verify
+        for file, remaining in self._file_pieces_remaining.items():
+            if remaining == 0:
+                self._file_statuses[file] = True
+
+        info_hash = self._torrent.info_hash
+        cache = HashCache(self._hash_cache_path)
+        keys = {path: file_key(path) for path in self._file_paths.values()}
+        cached = {path: cache.verified_pieces(info_hash, key) for path, key in keys.items()}
+
+        pending = []
+        for index, segments in enumerate(self._piece_segments):
+            if all(index in cached[path] for path, _, _ in segments):
+                self._mark_piece_verified(index)
+            else:
+                pending.append((index, segments))
+        print(f"{len(self._verified_pieces)} pieces verified from hash cache, {len(pending)} pieces left to hash.")
+        if not pending:
+            return
+
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        failed = 0
+        verified_by_path = {path: [] for path in keys}
+        executor = ProcessPoolExecutor(max_workers=self._verify_workers)
+        try:
+            futures = [self._hash_batch(executor, batch) for batch in batch_pieces(pending)]
+            # Results are applied as each batch finishes so verified pieces can be served immediately
+            for future in asyncio.as_completed(futures):
+                with self._profiler.span('verify_batch_wait'):
+                    batch_digests = await future
+                for index, digest in batch_digests:
+                    if digest != piece_hashes[index]:
+                        failed += 1
+                        continue
+                    self._mark_piece_verified(index)
+                    for path, _, _ in self._piece_segments[index]:
+                        verified_by_path[path].append(index)
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+            for path, indices in verified_by_path.items():
+                cache.record(info_hash, keys[path], indices)
+            cache.save()
+
+        print(f"Seed verification finished in {loop.time() - started:.2f}s: {len(self._verified_pieces)}/{len(piece_hashes)} pieces good, {failed} failed.")
+
+    async def _hash_batch(self, executor, batch):
+        # A failed worker (e.g. a broken process pool) fails only its own batch; the seeder keeps serving the rest
+        try:
+            return await asyncio.get_running_loop().run_in_executor(executor, hash_piece_batch, batch)
+        except Exception as e:
+            print(f"Error hashing pieces {batch[0][0]}-{batch[-1][0]}: {e!r}")
+            return [(index, None) for index, _ in batch]
+
+    def _mark_piece_verified(self, index):
+        if index in self._verified_pieces:
+            return
+        self._verified_pieces.add(index)
+        completed_files = []
+        for path, _, _ in self._piece_segments[index]:
+            file = self._path_files[path]
+            self._file_pieces_remaining[file] -= 1
+            if self._file_pieces_remaining[file] == 0:
+                self._file_statuses[file] = True
+                completed_files.append(file)
+                print(f"File '{file}' verified and ready to seed.")
+        return completed_files
 
     async def start_peer_server(self):
         # Start the P2P server to handle incoming peer connections
         self._peer_server = await asyncio.start_server(
             self._handle_peer_server_connection,
             self._kademlia_host,
-            self._kademlia_port
+            self._kademlia_port,
+            limit=READ_BUFFER_LIMIT
         )
         addr = self._peer_server.sockets[0].getsockname()
         print(f"Peer server started and listening on {addr}")
@@ -135,142 +471,496 @@ class P2PClient:
             is_download_complete = all(self._file_statuses.values())
 
             # ANNOUNCE OURSELVES TO THE DHT (the "set" call)
-            if self._is_seeder or is_download_complete:
-                info_hash_bytes = self._torrent.info_hash.encode('utf-8')
-                await self._kademlia_server.set(
-                    info_hash_bytes, 
-                    f"{self._kademlia_host}:{self._kademlia_port}".encode('utf-8')
-                )
-                print(f"Announced availability for info_hash: {self._torrent.info_hash}")
+            # A seeder announces once it has verified pieces to serve
+            if is_download_complete or (self._is_seeder and self._verified_pieces):
+                await self._announce()
+            elif self._is_seeder:
+                print("Waiting for seed verification before announcing.")
 
             # FIND PEERS TO DOWNLOAD FROM (the "get" call)
             if not self._is_seeder and not is_download_complete:
                 info_hash_bytes = self._torrent.info_hash.encode('utf-8')
-                found_peer = await self._kademlia_server.get(info_hash_bytes)
-                if found_peer:
-                    print(f"Found peer: {found_peer}")
-                    peer_info_str = found_peer.decode('utf-8')
-                    peer_ip, peer_port_str = peer_info_str.split(':')
-                    peer_port = int(peer_port_str)
-                    # Don't try to connect to ourselves
-                    if not (peer_ip == self._kademlia_host and peer_port == self._kademlia_port):
-                        print(f"Connecting to peer {peer_ip}:{peer_port} to download files...")
-                        asyncio.create_task(self._handle_peer_client_connection(peer_ip, peer_port))
-                       
-                # found_peers = await self._kademlia_server.get(info_hash_bytes)
-                # if found_peers:
-                #     print(f"Found peers: {found_peers}")
-                #     for peer_info in found_peers:
-                #         peer_info_str = peer_info.decode('utf-8')
-                #         peer_ip, peer_port_str = peer_info_str.split(':')
-                #         peer_port = int(peer_port_str)
-                #         # Don't try to connect to ourselves
-                #         if peer_ip != self._kademlia_host and peer_port != self._kademlia_port:
-                #             asyncio.create_task(self._handle_peer_client_connection(peer_ip, peer_port))
-                else:
+                with self._profiler.span('dht_get'):
+                    found_peers = self._parse_peer_list(await self._kademlia_server.get(info_hash_bytes))
+                # Don't try to connect to ourselves
+                found_peers = [peer for peer in found_peers if peer != (self._kademlia_host, self._kademlia_port)]
+                if found_peers:
+                    print(f"Found peers: {found_peers}")
+                    self._known_peers.update(found_peers)
+                elif not self._known_peers:
                     print("No peers found yet. Will try again.")
+                self._connect_to_best_peers()
             
             await asyncio.sleep(30) # Wait before trying again
     
+    @profiled('announce')
+    async def _announce(self):
+        # The DHT keeps one value per key, so merge ourselves into the existing peer list
+        info_hash_bytes = self._torrent.info_hash.encode('utf-8')
+        our_peer = (self._kademlia_host, self._kademlia_port)
+        with self._profiler.span('dht_get'):
+            existing = await self._kademlia_server.get(info_hash_bytes)
+        peers = [peer for peer in self._parse_peer_list(existing) if peer != our_peer]
+        peers = [our_peer] + peers[:MAX_ANNOUNCED_PEERS - 1]
+        with self._profiler.span('dht_set'):
+            await self._kademlia_server.set(
+                info_hash_bytes, 
+                ','.join(f"{ip}:{port}" for ip, port in peers).encode('utf-8')
+            )
+        print(f"Announced availability for info_hash: {self._torrent.info_hash}")
+
+    def _parse_peer_list(self, value):
+        # DHT values are comma separated "ip:port" entries
+        peers = []
+        if not value:
+            return peers
+        if isinstance(value, bytes):
+            value = value.decode('utf-8')
+        for entry in value.split(','):
+            try:
+                peer_ip, peer_port_str = entry.rsplit(':', 1)
+                peers.append((peer_ip, int(peer_port_str)))
+            except ValueError:
+                print(f"Ignoring malformed peer entry '{entry}'.")
+        return peers
+
+    def _active_peers(self):
+        return [peer for peer, task in self._peer_tasks.items() if not task.done()]
+
+    def _connect_to_best_peers(self):
+        # Drop peers that stayed far slower than the rest, then fill free slots best first
+        for peer in self._peer_quality.evict_slow_peers(self._active_peers()):
+            self._peer_tasks[peer].cancel()
+
+        active_peers = self._active_peers()
+        free_slots = MAX_DOWNLOAD_PEERS - len(active_peers)
+        candidates = [peer for peer in self._peer_quality.ranked(self._known_peers) if peer not in active_peers]
+        for peer_ip, peer_port in candidates[:max(free_slots, 0)]:
+            self._connect_to_peer(peer_ip, peer_port)
+
+    @profiled('handle_peer_server_connection')
     async def _handle_peer_server_connection(self, reader, writer):
         print("New incoming connection to peer server...")
         addr = writer.get_extra_info('peername')
+
+        # Wait for a free slot, or turn the peer away when we are overloaded
+        ip = addr[0] if addr else None
+        if not await self._admission.acquire(ip):
+            print(f"Rejecting connection from {addr}: too many connections ({self._admission.active} active, {self._admission.waiting} queued).")
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+            return
         print(f"Accepted incoming connection from peer: {addr}")
 
         try:
-            greeting = await reader.readuntil(b'\n')
+            greeting = await asyncio.wait_for(reader.readuntil(b'\n'), self._handshake_timeout)
             greeting_str = greeting.decode('utf-8').strip()
             if not greeting_str.startswith("HELLO:"):
                 print(f"Invalid greeting from {addr}. Disconnecting.")
                 return
+            # HELLO:<info_hash>[:<codec>,<codec>...] - answer a codec offer with the one we will use
+            peer_info_hash, _, offered_codecs = greeting_str.split(":", 1)[1].partition(":")
+            codec = CODEC_NONE
+            if offered_codecs:
+                if self._enable_compression:
+                    codec = choose_codec(offered_codecs.split(","))
+                writer.write(f"ACCEPT:{codec}\n".encode('utf-8'))
+                await self._drain(writer)
+                print(f"Using compression '{codec}' with peer {addr}.")
 
-            request = await reader.readuntil(b'\n')
-            request_str = request.decode('utf-8').strip()
-            
-            if request_str.startswith("GET_FILE:"):
-                requested_filename = request_str.split(":", 1)[1]
+            # Serve requests until the peer closes the connection
+            while True:
+                request = await asyncio.wait_for(reader.readline(), self._idle_timeout)
+                if not request:
+                    break
+                request_str = request.decode('utf-8').strip()
                 
-                async with self._download_lock:
-                    if self._file_statuses.get(requested_filename, False) and self._file_data.get(requested_filename):
+                if request_str.startswith("GET_FILE:"):
+                    requested_filename = request_str.split(":", 1)[1]
+                    
+                    # Only the status lookup is locked so a slow reader cannot hold up our own downloads
+                    async with self._profiler.timed_lock(self._download_lock, 'download_lock'):
+                        is_complete = self._file_statuses.get(requested_filename, False)
+                        file_data = self._file_data.get(requested_filename)
+
+                    if is_complete:
                         print(f"Peer {addr} is requesting file '{requested_filename}'. Sending...")
-                        
-                        file_data = self._file_data[requested_filename]
+
+                        if not file_data:
+                            # Seeders serve straight from disk instead of holding files in memory
+                            file_data = await asyncio.get_running_loop().run_in_executor(
+                                None, self._read_file, requested_filename
+                            )
                         file_size = len(file_data)
-                        
-                        file_size_bytes = file_size.to_bytes(LENGTH_HEADER_SIZE, 'big')
-                        writer.write(file_size_bytes)
-                        writer.write(file_data)
-                        await writer.drain()
+
+                        await self._send_payload(writer, codec, file_data)
                         print(f"Sent file '{requested_filename}' of size {file_size} to peer {addr}.")
                     else:
                         print(f"Peer {addr} requested file '{requested_filename}', but we do not have it yet. Disconnecting.")
-            else:
-                print(f"Peer {addr} sent an unknown request. Disconnecting.")
+                        break
+                elif request_str.startswith("GET_PIECE:"):
+                    await self._send_piece(writer, addr, request_str.split(":", 1)[1], codec)
+                elif request_str.startswith("GET_METADATA:"):
+                    await self._send_metadata(writer, addr, request_str.split(":", 1)[1], peer_info_hash)
+                else:
+                    print(f"Peer {addr} sent an unknown request. Disconnecting.")
+                    break
 
+        except asyncio.TimeoutError:
+            print(f"Peer {addr} stayed idle or stopped reading for too long. Disconnecting.")
         except asyncio.IncompleteReadError:
             print(f"Peer {addr} disconnected unexpectedly.")
+        except (asyncio.LimitOverrunError, ValueError):
+            print(f"Peer {addr} sent an oversized or malformed request. Disconnecting.")
         except Exception as e:
             print(f"Error handling server connection from {addr}: {e}")
         finally:
+            self._admission.release(ip)
             print(f"Closing server connection with {addr}")
             writer.close()
-            await writer.wait_closed()
+            try:
+                await asyncio.wait_for(writer.wait_closed(), self._idle_timeout)
+            except asyncio.TimeoutError:
+                writer.transport.abort() # Peer stopped reading, so drop whatever is still unsent
+            except ConnectionError:
+                pass # Peer already went away, e.g. after cancelling an endgame request
             
+    async def _drain(self, writer):
+        # Bound writes too, so a peer that stops reading cannot hold its admission slot forever.
+        # Large payloads are drained slice by slice, so this measures stalls, not the whole transfer
+        await asyncio.wait_for(writer.drain(), self._idle_timeout)
+
+    def _read_file(self, filename):
+        with open(self._file_paths[filename], 'rb') as f:
+            return f.read()
+
+    @profiled('send_payload')
+    async def _send_payload(self, writer, codec, data):
+        # Length-prefixed payload, compressed off the event loop when a codec was negotiated
+        if codec != CODEC_NONE:
+            with self._profiler.span('encode_payload'):
+                data = await asyncio.get_running_loop().run_in_executor(None, encode_payload, codec, data)
+        writer.write(len(data).to_bytes(LENGTH_HEADER_SIZE, 'big'))
+        with memoryview(data) as view:
+            for start in range(0, len(data), SEND_SLICE_SIZE):
+                writer.write(view[start:start + SEND_SLICE_SIZE])
+                await self._drain(writer)
+        await self._drain(writer)
+
+    async def _send_piece(self, writer, addr, index_str, codec=CODEC_NONE):
+        # A zero length header tells the peer we cannot serve this piece (yet)
+        try:
+            index = int(index_str)
+        except ValueError:
+            index = -1
+
+        piece_data = b''
+        if index in self._verified_pieces:
+            try:
+                piece_data = await asyncio.get_running_loop().run_in_executor(
+                    None, read_piece, self._piece_segments[index]
+                )
+            except (OSError, ValueError) as e:
+                print(f"Error reading piece {index} for peer {addr}: {e}")
+        else:
+            print(f"Peer {addr} requested piece '{index_str}', but we do not have it yet.")
+
+        await self._send_payload(writer, codec, piece_data)
+
+    def _connect_to_peer(self, peer_ip, peer_port):
+        # Keep at most one download connection per peer
+        task = self._peer_tasks.get((peer_ip, peer_port))
+        if (task and not task.done()) or self._peer_quality.is_skipped((peer_ip, peer_port), self._known_peers):
+            return
+        self._known_peers.add((peer_ip, peer_port))
+        print(f"Connecting to peer {peer_ip}:{peer_port} to download files...")
+        self._peer_tasks[(peer_ip, peer_port)] = asyncio.create_task(
+            self._handle_peer_client_connection(peer_ip, peer_port)
+        )
+
+    async def _send_metadata(self, writer, addr, chunk_str, peer_info_hash):
+        # Response: total metadata size, then one length-prefixed chunk of the info dict.
+        # A total size of zero means we have no metadata for the requested info_hash.
+        info_bytes = b''
+        if self._torrent and peer_info_hash == self._torrent.info_hash:
+            info_bytes = self._torrent.info_bytes
+        try:
+            chunk = int(chunk_str)
+        except ValueError:
+            chunk = -1
+
+        chunk_data = b''
+        if chunk >= 0:
+            chunk_data = info_bytes[chunk * METADATA_CHUNK_SIZE:(chunk + 1) * METADATA_CHUNK_SIZE]
+        if not chunk_data:
+            print(f"Peer {addr} requested metadata chunk '{chunk_str}' for {peer_info_hash}, which we cannot provide.")
+            info_bytes = b''
+        else:
+            print(f"Sending metadata chunk {chunk} to peer {addr}.")
+
+        writer.write(len(info_bytes).to_bytes(LENGTH_HEADER_SIZE, 'big'))
+        writer.write(len(chunk_data).to_bytes(LENGTH_HEADER_SIZE, 'big'))
+        writer.write(chunk_data)
+        await self._drain(writer)
+
+    @profiled('handle_peer_client_connection')
     async def _handle_peer_client_connection(self, peer_ip, peer_port):
         if self._is_seeder:
             return
 
         print(f"Attempting to connect to peer {peer_ip}:{peer_port} to download files...")
         
+        writer = None
+        reconnect = False
         try:
-            reader, writer = await asyncio.open_connection(peer_ip, peer_port)
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(peer_ip, peer_port), CONNECT_TIMEOUT)
             addr = writer.get_extra_info('peername')
             print(f"Successfully connected to peer {addr}")
 
-            our_greeting_message = f"HELLO:{self._torrent.info_hash}\n"
-            writer.write(our_greeting_message.encode('utf-8'))
-            await writer.drain()
-
-            files_to_download = [file for file in self._torrent.torrent_files if not self._file_statuses.get(file)]
-            
-            for filename in files_to_download:
-                request_message = f"GET_FILE:{filename}\n"
-                writer.write(request_message.encode('utf-8'))
-                await writer.drain()
-
-                received_data = await self._receive_file_data(reader)
+            codec = await self._send_greeting(reader, writer)
 
-                if received_data:
-                    async with self._download_lock:
-                        file_path = os.path.join(self._download_directory, filename)
-                        with open(file_path, 'wb') as f:
-                            f.write(received_data)
-                        self._file_statuses[filename] = True
-                        self._file_data[filename] = received_data
-                        print(f"Successfully downloaded and saved file '{filename}' from peer {addr}")
-                else:
-                    print(f"Failed to download file '{filename}' from peer {addr}")
-                    break 
+            if self._torrent.piece_hashes:
+                reconnect = await self._download_pieces(reader, writer, (peer_ip, peer_port), codec)
+            else:
+                await self._download_files(reader, writer, addr, codec)
+        except asyncio.TimeoutError:
+            print(f"Timed out connecting to peer {peer_ip}:{peer_port}.")
+            self._peer_quality.record_disconnect((peer_ip, peer_port))
         except asyncio.IncompleteReadError:
             print(f"Peer {peer_ip}:{peer_port} disconnected unexpectedly.")
+            self._peer_quality.record_disconnect((peer_ip, peer_port))
         except Exception as e:
             print(f"Error communicating with peer {peer_ip}:{peer_port}: {e}")
+            self._peer_quality.record_disconnect((peer_ip, peer_port))
         finally:
             if writer:
                 writer.close()
                 await writer.wait_closed()
 
-    async def _receive_file_data(self, reader):
+        if all(self._file_statuses.values()):
+            return
+        if reconnect:
+            # A cancelled endgame request leaves the stream mid-response, so start over on a fresh connection
+            self._peer_tasks.pop((peer_ip, peer_port), None)
+            self._connect_to_peer(peer_ip, peer_port)
+        else:
+            # Refill the slot now rather than on the next discovery round, after a short
+            # pause so a peer that is down is not hammered with connection attempts
+            await asyncio.sleep(PIECE_RETRY_DELAY)
+            self._peer_tasks.pop((peer_ip, peer_port), None)
+            self._connect_to_best_peers()
+
+    async def _send_greeting(self, reader, writer):
+        # Offer our codecs and return the one the peer chose for this connection
+        if not self._offered_codecs:
+            writer.write(f"HELLO:{self._torrent.info_hash}\n".encode('utf-8'))
+            await writer.drain()
+            return CODEC_NONE
+
+        writer.write(f"HELLO:{self._torrent.info_hash}:{','.join(self._offered_codecs)}\n".encode('utf-8'))
+        await writer.drain()
+        reply = await asyncio.wait_for(reader.readuntil(b'\n'), self._handshake_timeout)
+        reply_str = reply.decode('utf-8').strip()
+        if not reply_str.startswith("ACCEPT:"):
+            raise ValueError(f"unexpected handshake reply '{reply_str}'")
+        codec = reply_str.split(":", 1)[1]
+        if codec != CODEC_NONE and codec not in self._offered_codecs:
+            raise ValueError(f"peer chose a codec we did not offer: '{codec}'")
+        return codec
+
+    async def _receive_payload(self, reader, codec, max_size, timer=None):
+        # max_size is what the torrent says we should get; larger payloads are refused
+        # before they are read and decompression stops beyond it
+        received_data = await self._receive_file_data(reader, timer, max_encoded_size(codec, max_size))
+        if not received_data or codec == CODEC_NONE:
+            return received_data
         try:
-            header_bytes = await reader.readexactly(LENGTH_HEADER_SIZE)
+            with self._profiler.span('decode_payload'):
+                return await asyncio.get_running_loop().run_in_executor(
+                    None, decode_payload, codec, received_data, max_size
+                )
+        except Exception as e:
+            print(f"Error decompressing data: {e}")
+            return None
+
+    async def _download_files(self, reader, writer, addr, codec):
+        # Whole-file transfer for torrents that carry no piece hashes
+        files_to_download = [file for file in self._torrent.torrent_files if not self._file_statuses.get(file)]
+        file_lengths = dict(zip(self._torrent.torrent_files, self._torrent.file_lengths))
+        
+        for filename in files_to_download:
+            request_message = f"GET_FILE:{filename}\n"
+            writer.write(request_message.encode('utf-8'))
+            await writer.drain()
+
+            received_data = await self._receive_payload(reader, codec, file_lengths[filename])
+
+            if received_data:
+                async with self._profiler.timed_lock(self._download_lock, 'download_lock'):
+                    file_path = os.path.join(self._download_directory, filename)
+                    with open(file_path, 'wb') as f:
+                        f.write(received_data)
+                    self._file_statuses[filename] = True
+                    self._file_data[filename] = received_data
+                    print(f"Successfully downloaded and saved file '{filename}' from peer {addr}")
+            else:
+                print(f"Failed to download file '{filename}' from peer {addr}")
+                break 
+
+    async def _download_pieces(self, reader, writer, peer, codec):
+        # Request pieces from this peer one at a time until nothing is left to fetch.
+        # Returns True when the connection was given up because another peer won an endgame race.
+        # Timeouts come from the peer's quality record so they survive reconnects
+        timer = self._peer_quality.get(peer).timeout
+        unavailable = set() # Pieces this peer told us it does not have
+
+        while self._wanted_pieces:
+            if self._peer_quality.is_skipped(peer, self._known_peers):
+                return False
+            index = self._pick_piece(peer, unavailable)
+            if index is None:
+                # Everything left is unavailable here or already requested from enough peers
+                await asyncio.sleep(PIECE_RETRY_DELAY)
+                unavailable.clear()
+                continue
+
+            request_task = asyncio.create_task(self._request_piece(reader, writer, index, timer, codec))
+            self._piece_requests.setdefault(index, {})[peer] = request_task
+            # The request stays registered until the piece is stored, so no other peer picks it up meanwhile
+            try:
+                await asyncio.wait({request_task})
+                if request_task.cancelled():
+                    print(f"Piece {index} arrived from another peer first. Cancelled request to {peer}.")
+                    return True
+
+                piece_data = request_task.result()
+                if piece_data is None:
+                    # Timed out or failed; the piece goes back to the pool for other peers
+                    print(f"Dropping peer {peer} after a failed request for piece {index}.")
+                    self._peer_quality.record_error(peer)
+                    return False
+                if not piece_data:
+                    unavailable.add(index)
+                    continue
+                if await self._complete_piece(index, piece_data, peer):
+                    self._peer_quality.record_success(peer)
+                else:
+                    self._peer_quality.record_error(peer)
+            finally:
+                if not request_task.done():
+                    request_task.cancel()
+                requests = self._piece_requests.get(index, {})
+                requests.pop(peer, None)
+                if not requests:
+                    self._piece_requests.pop(index, None)
+
+        return False
+
+    def _pick_piece(self, peer, unavailable):
+        active_peers = self._active_peers()
+        is_slow = self._peer_quality.is_slow(peer, active_peers)
+
+        # Near the end, leave the last pieces to faster peers rather than a slow one
+        if is_slow:
+            unrequested = (index for index in self._wanted_pieces if index not in self._piece_requests)
+            if len(list(itertools.islice(unrequested, len(active_peers) + 1))) <= len(active_peers):
+                return None
+
+        # Normal mode: the first wanted piece nobody has requested yet
+        for index in self._wanted_pieces:
+            if index not in self._piece_requests and index not in unavailable:
+                return index
+
+        # Endgame: every remaining piece is in flight, so race the slowest ones on this peer too
+        if is_slow:
+            return None
+        candidates = [
+            index for index, requests in self._piece_requests.items()
+            if index in self._wanted_pieces and index not in unavailable
+            and peer not in requests and len(requests) < ENDGAME_MAX_REQUESTS
+        ]
+        if not candidates:
+            return None
+        index = min(candidates, key=lambda i: len(self._piece_requests[i]))
+        print(f"Endgame: requesting piece {index} from {peer} as well.")
+        return index
+
+    @profiled('request_piece')
+    async def _request_piece(self, reader, writer, index, timer, codec):
+        writer.write(f"GET_PIECE:{index}\n".encode('utf-8'))
+        await writer.drain()
+        piece_size = sum(length for _, _, length in self._piece_segments[index])
+        return await self._receive_payload(reader, codec, piece_size, timer)
+
+    @profiled('complete_piece')
+    async def _complete_piece(self, index, piece_data, peer):
+        loop = asyncio.get_running_loop()
+        digest = await loop.run_in_executor(None, lambda: hashlib.sha1(piece_data).digest())
+        if digest != self._torrent.piece_hashes[index]:
+            print(f"Piece {index} from {peer} failed hash check. Will request it again.")
+            return False
+
+        async with self._profiler.timed_lock(self._download_lock, 'download_lock'):
+            if index not in self._wanted_pieces:
+                return True
+            await loop.run_in_executor(None, self._write_piece, index, piece_data)
+            del self._wanted_pieces[index]
+
+            # Endgame duplicates of this piece are no longer needed
+            for other_peer, request_task in self._piece_requests.get(index, {}).items():
+                if other_peer != peer:
+                    request_task.cancel()
+
+            # Completed files are served from disk, so no in-memory copy is kept
+            for file in self._mark_piece_verified(index):
+                print(f"Successfully downloaded and saved file '{file}'")
+
+        if self._piece_store:
+            # The piece now lives in our download files, which is where the store serves it from
+            self._piece_store.add(self._torrent.piece_hashes[index], self._piece_segments[index], self._torrent.info_hash)
+            if not self._wanted_pieces:
+                await loop.run_in_executor(None, self._piece_store.save)
+        return True
+
+    def _write_piece(self, index, piece_data):
+        offset_in_piece = 0
+        for path, offset, length in self._piece_segments[index]:
+            with open(path, 'r+b') as f:
+                f.seek(offset)
+                f.write(piece_data[offset_in_piece:offset_in_piece + length])
+            offset_in_piece += length
+
+    @profiled('receive_file_data')
+    async def _receive_file_data(self, reader, timer=None, max_size=None):
+        # With a timer, both the response header and the body are bounded by
+        # the peer's adaptive timeouts and the measurements feed back into it.
+        # A body longer than max_size is refused without reading it.
+        try:
+            loop = asyncio.get_running_loop()
+            requested_at = loop.time()
+            header_timeout = timer.header_timeout() if timer else None
+            header_bytes = await asyncio.wait_for(reader.readexactly(LENGTH_HEADER_SIZE), header_timeout)
+            header_at = loop.time()
             total_data_size = int.from_bytes(header_bytes, 'big')
+            if max_size is not None and total_data_size > max_size:
+                print(f"Peer announced {total_data_size} bytes of data, more than the {max_size} expected.")
+                return None
             print(f"Expecting to receive {total_data_size} bytes of data.")
 
-            received_data = await reader.readexactly(total_data_size)
+            body_timeout = timer.body_timeout(total_data_size) if timer else None
+            received_data = await asyncio.wait_for(reader.readexactly(total_data_size), body_timeout)
+            if timer:
+                timer.record(header_at - requested_at, total_data_size, loop.time() - header_at)
             return received_data
+        except asyncio.TimeoutError:
+            print("Timed out waiting for file data.")
+            return None
         except asyncio.IncompleteReadError:
             print("Peer disconnected while receiving file data.")
             return None
         except Exception as e:
             print(f"Error receiving file data: {e}")
-            return None
\ No newline at end of file
+            return None
@@ -0,0 +1,123 @@
+import time
+from request_timeout import AdaptiveTimeout
+
+### PeerQualityTable remembers how each peer has performed, keyed by (ip, port).
+### It lives for the whole session so measurements survive reconnects and DHT
+### discovery rounds. Throughput and RTT come from the peer's AdaptiveTimeout
+### (EWMA) and are combined into the rate at which a typical piece arrives,
+### round trip included. Errors and disconnects are counted, and peers that keep
+### failing or stay far too slow are evicted for a while, unless there is no
+### other peer to turn to.
+
+MAX_CONSECUTIVE_FAILURES = 3    # Errors or disconnects in a row before a peer is evicted
+MIN_SAMPLES_FOR_SPEED = 5       # Pieces a peer must deliver before we judge its speed
+SLOW_PEER_RATIO = 0.1           # Slower than this fraction of the best peer counts as chronically slow
+EVICTION_PERIOD = 300           # Seconds an evicted peer is ignored
+REFERENCE_PIECE_SIZE = 256 * 1024  # Bytes used to weigh latency against throughput
+
+class PeerQuality(object):
+    def __init__(self):
+        self.timeout = AdaptiveTimeout()
+        self.successes = 0
+        self.errors = 0
+        self.disconnects = 0
+        self.consecutive_failures = 0
+        self.evicted_until = 0
+
+    @property
+    def throughput(self):
+        return self.timeout.throughput
+
+    @property
+    def rtt(self):
+        return self.timeout.srtt
+
+    @property
+    def effective_throughput(self):
+        # Bytes per second for a typical piece once the request round trip is paid for
+        if self.throughput is None:
+            return None
+        return REFERENCE_PIECE_SIZE / ((self.rtt or 0) + REFERENCE_PIECE_SIZE / self.throughput)
+
+    def score(self):
+        if self.throughput is None:
+            return None
+        return self.effective_throughput / (1 + self.errors + self.disconnects)
+
+    def rank_key(self):
+        # Untested peers rank first so every peer gets measured at least once, lowest RTT
+        # first when a round trip has been seen; measured peers follow best score first
+        if self.throughput is None:
+            return (0, self.rtt if self.rtt is not None else float('inf'))
+        return (1, -self.score())
+
+class PeerQualityTable(object):
+    def __init__(self):
+        self._peers = {}
+
+    def get(self, peer):
+        if peer not in self._peers:
+            self._peers[peer] = PeerQuality()
+        return self._peers[peer]
+
+    def record_success(self, peer):
+        quality = self.get(peer)
+        quality.successes += 1
+        quality.consecutive_failures = 0
+
+    def record_error(self, peer):
+        quality = self.get(peer)
+        quality.errors += 1
+        quality.consecutive_failures += 1
+        self._evict_if_failing(peer, quality)
+
+    def record_disconnect(self, peer):
+        quality = self.get(peer)
+        quality.disconnects += 1
+        quality.consecutive_failures += 1
+        self._evict_if_failing(peer, quality)
+
+    def _evict_if_failing(self, peer, quality):
+        if quality.consecutive_failures >= MAX_CONSECUTIVE_FAILURES:
+            self.evict(peer, f"{quality.consecutive_failures} failures in a row")
+
+    def evict(self, peer, reason):
+        quality = self.get(peer)
+        quality.evicted_until = time.monotonic() + EVICTION_PERIOD
+        quality.consecutive_failures = 0
+        print(f"Evicting peer {peer} for {EVICTION_PERIOD}s: {reason}.")
+
+    def is_evicted(self, peer):
+        quality = self._peers.get(peer)
+        return quality is not None and quality.evicted_until > time.monotonic()
+
+    def best_throughput(self, peers):
+        throughputs = [self.get(peer).effective_throughput for peer in peers if self.get(peer).throughput]
+        return max(throughputs, default=None)
+
+    def is_slow(self, peer, peers):
+        # Slow relative to the fastest of the given peers, latency included
+        throughput = self.get(peer).effective_throughput
+        best = self.best_throughput(peers)
+        if throughput is None or best is None:
+            return False
+        return throughput < best * SLOW_PEER_RATIO
+
+    def evict_slow_peers(self, peers):
+        # Evict peers that have had a fair chance and remain far slower than the best
+        evicted = []
+        for peer in peers:
+            if self.get(peer).successes >= MIN_SAMPLES_FOR_SPEED and self.is_slow(peer, peers):
+                self.evict(peer, "chronically slow")
+                evicted.append(peer)
+        return evicted
+
+    def is_skipped(self, peer, peers):
+        # Evicted peers are passed over only while another of `peers` is still usable,
+        # so a download never stalls on the one peer we know
+        return self.is_evicted(peer) and any(not self.is_evicted(other) for other in peers if other != peer)
+
+    def ranked(self, peers):
+        # Best first, skipped peers left out
+        candidates = [peer for peer in peers if not self.is_skipped(peer, peers)]
+        return sorted(candidates, key=lambda peer: self.get(peer).rank_key())
@@ -0,0 +1,109 @@
+import hashlib
+import mmap
+
+### Piece hashing helpers shared by torrent creation and seeder verification.
+### Pieces are laid out across the torrent files back to back, so a single piece
+### may span the end of one file and the start of the next. The worker functions
+### are module level so they can be pickled into a ProcessPoolExecutor.
+
+PIECE_HASH_SIZE = 20
+MIN_PIECE_LENGTH = 16 * 1024
+MAX_PIECE_LENGTH = 16 * 1024 * 1024
+TARGET_PIECE_COUNT = 2000
+BATCH_SIZE = 64 * 1024 * 1024 # Bytes of data handed to a worker per task
+
+def choose_piece_length(total_size):
+    # Smallest power of two that keeps the piece count near TARGET_PIECE_COUNT
+    piece_length = MIN_PIECE_LENGTH
+    while piece_length < MAX_PIECE_LENGTH and total_size // piece_length > TARGET_PIECE_COUNT:
+        piece_length *= 2
+    return piece_length
+
+def build_piece_segments(file_entries, piece_length):
+    # file_entries is a list of (path, length) in torrent order.
+    # Returns one list of (path, offset, length) segments per piece.
+    pieces = []
+    current = []
+    current_size = 0
+
+    for path, length in file_entries:
+        offset = 0
+        while offset < length:
+            take = min(piece_length - current_size, length - offset)
+            current.append((path, offset, take))
+            current_size += take
+            offset += take
+            if current_size == piece_length:
+                pieces.append(current)
+                current = []
+                current_size = 0
+
+    if current:
+        pieces.append(current)
+    return pieces
+
+def batch_pieces(indexed_segments, batch_size=BATCH_SIZE):
+    # Group (index, segments) pairs into batches so each worker task
+    # hashes a reasonable amount of data.
+    batches = []
+    batch = []
+    batch_bytes = 0
+
+    for index, segments in indexed_segments:
+        batch.append((index, segments))
+        batch_bytes += sum(length for _, _, length in segments)
+        if batch_bytes >= batch_size:
+            batches.append(batch)
+            batch = []
+            batch_bytes = 0
+
+    if batch:
+        batches.append(batch)
+    return batches
+
+def hash_piece_batch(batch):
+    # Worker: hash every piece in the batch using memory-mapped reads.
+    # Returns (index, SHA1 digest) pairs, with None for pieces that could not be read.
+    files = {}
+    maps = {}
+    digests = []
+
+    try:
+        for index, segments in batch:
+            sha1 = hashlib.sha1()
+            try:
+                for path, offset, length in segments:
+                    if path not in maps:
+                        f = open(path, 'rb')
+                        files[path] = f
+                        maps[path] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    mapped = maps[path]
+                    if offset + length > len(mapped):
+                        raise ValueError(f'File is shorter than expected: {path}')
+                    with memoryview(mapped) as view:
+                        sha1.update(view[offset:offset + length])
+                digests.append((index, sha1.digest()))
+            except (OSError, ValueError):
+                digests.append((index, None))
+    finally:
+        for mapped in maps.values():
+            mapped.close()
+        for f in files.values():
+            f.close()
+
+    return digests
+
+def read_piece(segments):
+    # Read a single piece back from disk by concatenating its file segments
+    data = bytearray()
+    for path, offset, length in segments:
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            chunk = f.read(length)
+        if len(chunk) != length:
+            raise ValueError(f'File is shorter than expected: {path}')
+        data += chunk
+    return bytes(data)
+
+def split_piece_hashes(pieces):
+    return [pieces[i:i + PIECE_HASH_SIZE] for i in range(0, len(pieces), PIECE_HASH_SIZE)]
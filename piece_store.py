@@ -0,0 +1,273 @@
+from bcoding import bdecode, bencode
+import contextlib
+import hashlib
+import os
+import threading
+import time
+from piece_hasher import read_piece
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None # Not available on Windows; the index is then only safe within one process
+
+### PieceStore is a content-addressed index of pieces shared by every torrent on this node.
+### Pieces are keyed by their SHA1 hash, so torrents that share content (e.g. versions of
+### the same dataset) share pieces. A piece is indexed by reference: the store records the
+### (path, offset, length) segments where each torrent holds it in its own files, and only
+### writes a copy of its own once no torrent's files hold the piece any more. Each piece
+### remembers which info_hashes reference it. Copies of unreferenced pieces are evicted
+### least recently used first when the store would exceed its capacity. Methods are safe
+### to call from executor threads. Several nodes may share a store directory: additions
+### are kept in memory until save(), and every write to the index happens under a file
+### lock, starting from the index on disk with our unsaved additions replayed on top.
+
+STORE_VERSION = 1
+INDEX_FILE_NAME = 'index'
+LOCK_FILE_NAME = 'index.lock'
+
+class PieceStore(object):
+    def __init__(self, directory, capacity=None):
+        self._directory = directory
+        self._capacity = capacity # Bytes of copies held by the store itself, None for unbounded
+        self._lock = threading.Lock()
+        self._pieces = {}         # Piece hash hex -> {'size', 'refs', 'atime', 'sources', 'stored'}
+        self._total_size = 0
+        self._pending_adds = {}   # (piece hash hex, info_hash) -> segments added since the last save
+        self._pending_atimes = {} # Piece hash hex -> last access since the last save
+
+        os.makedirs(self._directory, exist_ok=True)
+        self._load()
+
+    def _index_path(self):
+        return os.path.join(self._directory, INDEX_FILE_NAME)
+
+    def _piece_path(self, key):
+        return os.path.join(self._directory, key[:2], key)
+
+    def _lock_path(self):
+        return os.path.join(self._directory, LOCK_FILE_NAME)
+
+    def _load(self):
+        self._pieces = {}
+        self._total_size = 0
+        if not os.path.isfile(self._index_path()):
+            return
+        try:
+            with open(self._index_path(), 'rb') as f:
+                data = bdecode(f.read())
+        except Exception as e:
+            print(f"Ignoring unreadable piece store index {self._index_path()}: {e}")
+            return
+        if data.get('version') != STORE_VERSION:
+            print(f"Ignoring piece store index {self._index_path()} with unknown version.")
+            return
+        for key, entry in data.get('pieces', {}).items():
+            # Forget copies whose file went missing; sources are checked when they are read
+            if entry['stored'] and not os.path.isfile(self._piece_path(key)):
+                entry['stored'] = 0
+            if entry['stored'] or entry['sources']:
+                self._pieces[key] = entry
+                if entry['stored']:
+                    self._total_size += entry['size']
+
+    def save(self):
+        with self._locked_index():
+            pass # Reloading, replaying our additions and writing back is all a save takes
+
+    @contextlib.contextmanager
+    def _locked_index(self):
+        # Other nodes sharing the directory may have changed the index since we read it
+        with self._lock, open(self._lock_path(), 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX) # Released when the file is closed
+            self._load()
+            self._apply_pending()
+            yield
+            tmp_path = self._index_path() + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(bencode({'version': STORE_VERSION, 'pieces': self._pieces}))
+            os.replace(tmp_path, self._index_path())
+            self._pending_adds.clear()
+            self._pending_atimes.clear()
+
+    def _apply_pending(self):
+        for (key, info_hash), segments in self._pending_adds.items():
+            self._add_source(key, info_hash, segments)
+            # A torrent's files hold the piece again, so our own copy is redundant
+            self._drop_copy(key)
+        for key, atime in self._pending_atimes.items():
+            if key in self._pieces:
+                self._pieces[key]['atime'] = max(self._pieces[key]['atime'], atime)
+
+    @property
+    def total_size(self):
+        # Bytes held in the store's own copies; indexed pieces in torrent files are not counted
+        return self._total_size
+
+    def has(self, piece_hash):
+        return piece_hash.hex() in self._pieces
+
+    def get(self, piece_hash):
+        # Returns the piece data, or None if no copy or source of it is intact any more
+        key = piece_hash.hex()
+        with self._lock:
+            entry = self._pieces.get(key)
+            if entry is None:
+                return None
+            stored = entry['stored']
+            sources = list(entry['sources'].items())
+
+        if stored:
+            try:
+                with open(self._piece_path(key), 'rb') as f:
+                    data = f.read()
+            except OSError:
+                data = None
+            if data is not None and hashlib.sha1(data).digest() == piece_hash:
+                with self._lock:
+                    self._pending_atimes[key] = int(time.time())
+                    if key in self._pieces:
+                        self._pieces[key]['atime'] = self._pending_atimes[key]
+                return data
+            print(f"Dropping corrupt piece {key} from the piece store.")
+            with self._lock:
+                self._drop_copy(key)
+
+        for info_hash, segments in sources:
+            data = _read_source(segments, piece_hash)
+            if data is not None:
+                return data
+            print(f"Dropping stale location of piece {key} for torrent {info_hash}.")
+            with self._lock:
+                self._drop_source(key, info_hash)
+        return None
+
+    def add(self, piece_hash, segments, info_hash):
+        # Index a verified piece that a torrent holds at `segments` in its own files; nothing
+        # is copied. It reaches the index on disk with the next save().
+        key = piece_hash.hex()
+        segments = [[os.path.abspath(path), offset, length] for path, offset, length in segments]
+        with self._lock:
+            self._pending_adds[(key, info_hash)] = segments
+            self._add_source(key, info_hash, segments)
+
+    def refcount(self, piece_hash):
+        entry = self._pieces.get(piece_hash.hex())
+        return len(entry['refs']) if entry else 0
+
+    def release(self, info_hash):
+        # Drop a torrent's references and locations. Pieces no other torrent holds on disk
+        # are copied into the store first, and stay until space is needed.
+        released = 0
+        with self._locked_index():
+            for key, entry in list(self._pieces.items()):
+                if info_hash not in entry['refs']:
+                    continue
+                entry['refs'].remove(info_hash)
+                released += 1
+                self._keep_copy_if_orphaned(key, entry['sources'].pop(info_hash, None))
+            if self._capacity is not None:
+                self._make_room(0)
+        return released
+
+    def detach_files(self, paths, info_hash):
+        # The files at `paths` are about to be rewritten for `info_hash`, so other torrents'
+        # pieces located there are copied into the store unless they are held elsewhere too
+        paths = {os.path.abspath(path) for path in paths}
+        detached = 0
+        with self._locked_index():
+            for key, entry in list(self._pieces.items()):
+                for other_info_hash, segments in list(entry['sources'].items()):
+                    if other_info_hash == info_hash or not any(path in paths for path, _, _ in segments):
+                        continue
+                    del entry['sources'][other_info_hash]
+                    self._keep_copy_if_orphaned(key, segments)
+                    detached += 1
+        return detached
+
+    def _add_source(self, key, info_hash, segments):
+        if key not in self._pieces:
+            size = sum(length for _, _, length in segments)
+            self._pieces[key] = {'size': size, 'refs': [], 'atime': int(time.time()), 'sources': {}, 'stored': 0}
+        entry = self._pieces[key]
+        if info_hash not in entry['refs']:
+            entry['refs'].append(info_hash)
+        entry['sources'][info_hash] = segments
+        entry['atime'] = int(time.time())
+
+    def _keep_copy_if_orphaned(self, key, segments):
+        # Called once a location is dropped: copy the piece from it unless the store or
+        # another torrent's files still hold the piece
+        entry = self._pieces[key]
+        if entry['stored'] or entry['sources']:
+            return
+        data = _read_source(segments, bytes.fromhex(key)) if segments else None
+        if data is None or not self._store_copy(key, data):
+            del self._pieces[key]
+
+    def _store_copy(self, key, data):
+        if self._capacity is not None and not self._make_room(len(data)):
+            return False
+        path = self._piece_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+        self._pieces[key]['stored'] = 1
+        self._total_size += len(data)
+        return True
+
+    def _make_room(self, needed):
+        # Evict copies of unreferenced pieces, least recently used first, until `needed` more bytes fit
+        if self._total_size + needed <= self._capacity:
+            return True
+        unreferenced = sorted(
+            (entry['atime'], key) for key, entry in self._pieces.items() if entry['stored'] and not entry['refs']
+        )
+        for _, key in unreferenced:
+            self._remove(key)
+            if self._total_size + needed <= self._capacity:
+                return True
+        return False
+
+    def _drop_copy(self, key):
+        entry = self._pieces.get(key)
+        if entry is None or not entry['stored']:
+            return
+        entry['stored'] = 0
+        self._total_size -= entry['size']
+        _remove_file(self._piece_path(key))
+        if not entry['sources']:
+            del self._pieces[key]
+
+    def _drop_source(self, key, info_hash):
+        entry = self._pieces.get(key)
+        if entry is None:
+            return
+        entry['sources'].pop(info_hash, None)
+        if not entry['sources'] and not entry['stored']:
+            del self._pieces[key]
+
+    def _remove(self, key):
+        entry = self._pieces.pop(key, None)
+        if entry is None or not entry['stored']:
+            return
+        self._total_size -= entry['size']
+        _remove_file(self._piece_path(key))
+
+def _read_source(segments, piece_hash):
+    # Read a piece back from a torrent's files, or None if it is gone or no longer matches
+    try:
+        data = read_piece(segments)
+    except (OSError, ValueError):
+        return None
+    return data if hashlib.sha1(data).digest() == piece_hash else None
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
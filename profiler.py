@@ -0,0 +1,140 @@
+import asyncio
+import contextlib
+import contextvars
+import cProfile
+import functools
+import time
+
+### Profiling hooks for finding where a node spends its time.
+### Profiler samples asyncio event-loop lag, records wall-clock timing spans for
+### coroutines and hot-path stages, and on stop() writes:
+###   <output>.prof    cProfile stats (snakeviz, gprof2dot, flameprof, pstats)
+###   <output>.folded  span stacks in folded format (flamegraph.pl, speedscope)
+### Code is always instrumented; when profiling is off it talks to NULL_PROFILER,
+### whose spans are a shared no-op context manager.
+
+LAG_SAMPLE_INTERVAL = 0.1 # Seconds between event-loop lag samples
+
+_current_stack = contextvars.ContextVar('profiler_span_stack', default=())
+
+class _Frame(object):
+    __slots__ = ('name', 'task', 'child_time')
+
+    def __init__(self, name, task):
+        self.name = name
+        self.task = task
+        self.child_time = 0.0
+
+class Profiler(object):
+    def __init__(self, output_path, lag_interval=LAG_SAMPLE_INTERVAL):
+        self._output_path = output_path
+        self._lag_interval = lag_interval
+        self._cprofile = cProfile.Profile()
+        self._lag_task = None
+        self._lag_samples = []
+        self._spans = {}   # Span name -> [count, total seconds, max seconds]
+        self._folded = {}  # "outer;inner" stack -> exclusive seconds
+
+    def start(self):
+        # Must be called from within the running event loop
+        self._lag_task = asyncio.get_running_loop().create_task(self._sample_loop_lag())
+        self._cprofile.enable()
+        print(f"Profiling enabled, writing results to {self._output_path}.prof and {self._output_path}.folded")
+
+    def stop(self):
+        self._cprofile.disable()
+        if self._lag_task:
+            self._lag_task.cancel()
+        self._cprofile.dump_stats(f"{self._output_path}.prof")
+        with open(f"{self._output_path}.folded", 'w') as f:
+            for stack, seconds in sorted(self._folded.items()):
+                # Integer microseconds, the usual weight for folded stacks
+                f.write(f"{stack} {int(seconds * 1_000_000)}\n")
+        self.print_summary()
+
+    async def _sample_loop_lag(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            scheduled = loop.time()
+            await asyncio.sleep(self._lag_interval)
+            self._lag_samples.append(max(0.0, loop.time() - scheduled - self._lag_interval))
+
+    @contextlib.contextmanager
+    def span(self, name):
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            task = None # Not running inside the event loop
+        stack = _current_stack.get()
+        if stack and stack[-1].task is not task:
+            # Spans opened in the task that created this one are not our parents
+            stack = ()
+        frame = _Frame(name, task)
+        token = _current_stack.set(stack + (frame,))
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            _current_stack.reset(token)
+            self._record(stack, frame, elapsed)
+
+    @contextlib.asynccontextmanager
+    async def timed_lock(self, lock, name):
+        # Acquire an asyncio lock, timing the wait separately from the time it is held
+        with self.span(f"{name}_wait"):
+            await lock.acquire()
+        try:
+            with self.span(f"{name}_held"):
+                yield
+        finally:
+            lock.release()
+
+    def _record(self, stack, frame, elapsed):
+        stats = self._spans.setdefault(frame.name, [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += elapsed
+        stats[2] = max(stats[2], elapsed)
+
+        path = ';'.join([parent.name for parent in stack] + [frame.name])
+        self._folded[path] = self._folded.get(path, 0.0) + max(0.0, elapsed - frame.child_time)
+        if stack:
+            stack[-1].child_time += elapsed
+
+    def print_summary(self):
+        if self._lag_samples:
+            samples = sorted(self._lag_samples)
+            p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+            print(f"Event loop lag: {len(samples)} samples, mean {sum(samples) / len(samples) * 1000:.2f}ms, "
+                  f"p99 {p99 * 1000:.2f}ms, max {samples[-1] * 1000:.2f}ms")
+        print("Span timings (count, total, mean, max):")
+        for name, (count, total, longest) in sorted(self._spans.items(), key=lambda item: item[1][1], reverse=True):
+            print(f"  {name}: {count}, {total:.3f}s, {total / count * 1000:.2f}ms, {longest * 1000:.2f}ms")
+
+def profiled(name):
+    # Decorator for coroutine methods of objects holding a `_profiler`; times each call as a span
+    def decorator(method):
+        @functools.wraps(method)
+        async def wrapper(self, *args, **kwargs):
+            with self._profiler.span(name):
+                return await method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+class _NullProfiler(object):
+    # Stand-in used when profiling is off: every hook is a near free no-op
+    _null_span = contextlib.nullcontext()
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def span(self, name):
+        return self._null_span
+
+    def timed_lock(self, lock, name):
+        return lock
+
+NULL_PROFILER = _NullProfiler()
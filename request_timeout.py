@@ -0,0 +1,60 @@
+### AdaptiveTimeout estimates how long a peer should take to answer a request.
+### Round-trip time is smoothed like TCP's retransmission timer (SRTT + 4 * RTTVAR)
+### and transfer time is derived from an EWMA of the peer's throughput. Until a
+### peer has answered anything, a conservative initial timeout is used and the
+### body is assumed to arrive no faster than a slow link's FLOOR_THROUGHPUT.
+
+MIN_TIMEOUT = 2.0
+MAX_TIMEOUT = 120.0
+INITIAL_TIMEOUT = 30.0
+RTT_ALPHA = 0.125
+RTT_BETA = 0.25
+THROUGHPUT_ALPHA = 0.3
+TRANSFER_SLACK = 3.0 # Allow a transfer to run this many times slower than expected
+FLOOR_THROUGHPUT = 32 * 1024 # Bytes per second assumed for a peer we have not measured yet
+
+def _clamp(value):
+    return max(MIN_TIMEOUT, min(MAX_TIMEOUT, value))
+
+class AdaptiveTimeout(object):
+    def __init__(self):
+        self._srtt = None
+        self._rttvar = None
+        self._throughput = None # Bytes per second
+
+    def record(self, rtt, size, duration):
+        # rtt: seconds from sending a request to receiving the response header
+        # size, duration: body bytes and the seconds they took to arrive
+        if self._srtt is None:
+            self._srtt = rtt
+            self._rttvar = rtt / 2
+        else:
+            self._rttvar = (1 - RTT_BETA) * self._rttvar + RTT_BETA * abs(self._srtt - rtt)
+            self._srtt = (1 - RTT_ALPHA) * self._srtt + RTT_ALPHA * rtt
+
+        if size > 0 and duration > 0:
+            sample = size / duration
+            if self._throughput is None:
+                self._throughput = sample
+            else:
+                self._throughput = (1 - THROUGHPUT_ALPHA) * self._throughput + THROUGHPUT_ALPHA * sample
+
+    def header_timeout(self):
+        if self._srtt is None:
+            return INITIAL_TIMEOUT
+        return _clamp(self._srtt + 4 * self._rttvar)
+
+    def body_timeout(self, size):
+        # Only the latency part is capped; the transfer part grows with the payload so
+        # large pieces on slow links can finish and give us a throughput sample
+        if self._throughput is None:
+            return INITIAL_TIMEOUT + size / FLOOR_THROUGHPUT
+        return self.header_timeout() + TRANSFER_SLACK * size / self._throughput
+
+    @property
+    def srtt(self):
+        return self._srtt
+
+    @property
+    def throughput(self):
+        return self._throughput
@@ -1,9 +1,10 @@
 from bcoding import bdecode, bencode
 import hashlib
 import os
+from piece_hasher import split_piece_hashes
 
 ### Torrent class to handle torrent file operations
-### It reads the torrent file, extracts files and bootstrap nodes, and computes the info hash.
+### It reads the torrent file, extracts files, piece hashes and bootstrap nodes, and computes the info hash.
 
 class Torrent(object):
     def __init__(self, path):
@@ -11,8 +12,12 @@ class Torrent(object):
 
         self._torrent_data = None
         self._torrent_files = []
+        self._file_lengths = []
+        self._piece_length = 0
+        self._piece_hashes = []
         self._bootstrap_nodes = []
         self._info_hash = None
+        self._info_bytes = b''
 
         self._extract_torrent_metadata()
 
@@ -33,6 +38,14 @@ class Torrent(object):
                 if len(path_list) > 0:
                     file_name = path_list[0]
                     self._torrent_files.append(file_name)
+                    self._file_lengths.append(file.get('length', 0))
+
+        self._piece_length = self._torrent_data.get('info', {}).get('piece length', 0)
+        pieces = self._torrent_data.get('info', {}).get('pieces', b'')
+        if isinstance(pieces, str):
+            # bcoding decodes any valid utf-8 buffer to str, undo that for the raw hashes
+            pieces = pieces.encode()
+        self._piece_hashes = split_piece_hashes(pieces)
 
         nodes = self._torrent_data.get('nodes', [])
         if len(nodes) > 0:
@@ -45,13 +58,26 @@ class Torrent(object):
         
         torrent_info = self._torrent_data.get('info', {})
         if torrent_info:
-            info_hash = hashlib.sha1(bencode(torrent_info)).digest()
+            self._info_bytes = bencode(torrent_info)
+            info_hash = hashlib.sha1(self._info_bytes).digest()
             self._info_hash = info_hash.hex()
 
     @property
     def torrent_files(self):
         return self._torrent_files
     
+    @property
+    def file_lengths(self):
+        return self._file_lengths
+
+    @property
+    def piece_length(self):
+        return self._piece_length
+
+    @property
+    def piece_hashes(self):
+        return self._piece_hashes
+
     @property
     def bootstrap_nodes(self):
         return self._bootstrap_nodes
@@ -59,3 +85,8 @@ class Torrent(object):
     @property
     def info_hash(self):   
         return self._info_hash
+
+    @property
+    def info_bytes(self):
+        # Bencoded info dict, served to peers fetching metadata by info_hash
+        return self._info_bytes
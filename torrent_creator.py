@@ -0,0 +1,95 @@
+from bcoding import bencode
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import os
+import time
+from hash_cache import RESUME_FILE_SUFFIX, HashCache, default_cache_path, file_key
+from piece_hasher import batch_pieces, build_piece_segments, choose_piece_length, hash_piece_batch
+
+### TorrentCreator builds a .torrent file for the files in a directory.
+### Pieces are hashed in parallel across a process pool using memory-mapped reads,
+### the bootstrap nodes are written to `nodes`, and the fast-resume state can be
+### emitted so the seeder does not need to hash the data again on startup.
+
+CREATED_BY = 'p2p-file-sharing-client'
+# Torrents, resume/hash cache files and their partial writes may live next to the data
+EXCLUDED_SUFFIXES = ('.torrent', RESUME_FILE_SUFFIX, '.tmp')
+
+class TorrentCreator(object):
+    def __init__(self, source_directory, bootstrap_nodes, piece_length=None, workers=None):
+        self._source_directory = source_directory
+        self._bootstrap_nodes = bootstrap_nodes
+        self._piece_length = piece_length
+        self._workers = workers
+
+    def _collect_files(self):
+        # Same layout the seeder expects: regular files directly inside the directory
+        if not os.path.isdir(self._source_directory):
+            raise NotADirectoryError(f'Source directory not found: {self._source_directory}')
+
+        files = []
+        for name in sorted(os.listdir(self._source_directory)):
+            path = os.path.join(self._source_directory, name)
+            if os.path.isfile(path) and not name.endswith(EXCLUDED_SUFFIXES):
+                files.append((name, path))
+
+        if not files:
+            raise ValueError(f'No files to share in {self._source_directory}')
+        return files
+
+    def create(self, torrent_file_path, write_resume=False):
+        files = self._collect_files()
+        # Take file identities before hashing so changes made meanwhile invalidate the resume state
+        keys = [file_key(path) for _, path in files]
+        file_entries = [(path, key[1]) for (_, path), key in zip(files, keys)]
+
+        total_size = sum(length for _, length in file_entries)
+        piece_length = self._piece_length or choose_piece_length(total_size)
+        piece_segments = build_piece_segments(file_entries, piece_length)
+        print(f"Hashing {len(piece_segments)} pieces of {piece_length} bytes ({total_size} bytes total)...")
+
+        started = time.monotonic()
+        digests = [None] * len(piece_segments)
+        with ProcessPoolExecutor(max_workers=self._workers) as executor:
+            for batch_digests in executor.map(hash_piece_batch, batch_pieces(enumerate(piece_segments))):
+                for index, digest in batch_digests:
+                    if digest is None:
+                        raise IOError(f'Failed to read piece {index} while hashing.')
+                    digests[index] = digest
+        print(f"Hashed {total_size} bytes in {time.monotonic() - started:.2f}s.")
+
+        info = {
+            'name': os.path.basename(os.path.normpath(self._source_directory)),
+            'piece length': piece_length,
+            'pieces': b''.join(digests),
+            'files': [{'length': length, 'path': [name]} for (name, _), (_, length) in zip(files, file_entries)],
+        }
+        torrent_data = {
+            'info': info,
+            'nodes': [[host, port] for host, port in self._bootstrap_nodes],
+            'created by': CREATED_BY,
+            'creation date': int(time.time()),
+        }
+
+        with open(torrent_file_path, 'wb') as f:
+            f.write(bencode(torrent_data))
+        info_hash = hashlib.sha1(bencode(info)).hexdigest()
+        print(f"Torrent written to {torrent_file_path} (info_hash {info_hash})")
+
+        if write_resume:
+            self._write_resume(torrent_file_path, info_hash, files, keys, piece_segments)
+
+        return info_hash
+
+    def _write_resume(self, torrent_file_path, info_hash, files, keys, piece_segments):
+        # Every piece was just hashed from these files, so all of them are verified
+        pieces_per_file = {path: [] for _, path in files}
+        for index, segments in enumerate(piece_segments):
+            for path, _, _ in segments:
+                pieces_per_file[path].append(index)
+
+        cache = HashCache(default_cache_path(torrent_file_path))
+        for (_, path), key in zip(files, keys):
+            cache.record(info_hash, key, pieces_per_file[path])
+        cache.save()
+        print(f"Fast-resume state written to {default_cache_path(torrent_file_path)}")